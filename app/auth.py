@@ -4,29 +4,70 @@ from datetime import datetime, timedelta
 from fastapi import APIRouter, HTTPException, Depends, Header
 from typing import Optional, Dict
 from .config import settings
-from .db import users_col, resets_col
+from .db import users_col, resets_col, EMAIL_COLLATION
 from .models import User
-from pydantic import BaseModel
+from pydantic import BaseModel, EmailStr, field_validator
+from pymongo.errors import DuplicateKeyError
 import uuid
+import asyncio
+import logging
+import hashlib
+import hmac
+import time
+import threading
+from collections import OrderedDict
 
 router = APIRouter(prefix="/auth", tags=["auth"])
 
-pwd_ctx = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# argon2 is the default; existing bcrypt hashes still verify and are upgraded on next login
+pwd_ctx = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__memory_cost=19456,
+    argon2__time_cost=2,
+    argon2__parallelism=1,
+)
 JWT_ALG = "HS256"
 JWT_EXP_MIN = 60 * 24  # 24h
 
+# Prepared once at import instead of per encode/decode call
+_SIGNING_KEY = settings.secret_key.encode()
+_JWT_ALGS = [JWT_ALG]
+
+# Short-lived cache of successful password checks so repeat logins skip the slow hash.
+# Only hits are stored, so a wrong password always pays the full hash cost.
+_VERIFY_CACHE_MAX = 1024
+_VERIFY_CACHE_TTL = 60  # seconds
+_verify_cache: "OrderedDict[tuple[bytes, str], float]" = OrderedDict()
+_verify_lock = threading.Lock()  # verify_password runs on executor threads
+
+# token -> (payload, exp, user doc, user cached until); skips jwt.decode for the token's
+# lifetime, and the user lookup for a short while so deleted users lose access quickly
+_TOK_CACHE_MAX = 2048
+_TOK_USER_TTL = 60  # seconds
+_tok_cache: "OrderedDict[str, tuple[dict, float, dict, float]]" = OrderedDict()
+
+def _normalize_email(v):
+    return v.strip().lower() if isinstance(v, str) else v
+
 class SignupIn(BaseModel):
-    email: str
+    email: EmailStr
     password: str
     name: Optional[str] = None
 
+    _lc_email = field_validator("email", mode="before")(_normalize_email)
+
 class LoginIn(BaseModel):
-    email: str
+    email: str  # not EmailStr: existing accounts may use addresses it rejects
     password: str
 
+    _lc_email = field_validator("email", mode="before")(_normalize_email)
+
 class ResetRequestIn(BaseModel):
     email: str
 
+    _lc_email = field_validator("email", mode="before")(_normalize_email)
+
 class ResetConfirmIn(BaseModel):
     token: str
     new_password: str
@@ -36,19 +77,61 @@ def hash_password(password: str) -> str:
     return pwd_ctx.hash(password)
 
 def verify_password(password: str, hashed: str) -> bool:
-    return pwd_ctx.verify(password, hashed)
+    k = (hashlib.sha256(password.encode()).digest(), hashed)
+    now = time.monotonic()
+    with _verify_lock:
+        ts = _verify_cache.get(k)
+        if ts is not None and now - ts < _VERIFY_CACHE_TTL:
+            _verify_cache.move_to_end(k)
+            return True
+    if not pwd_ctx.verify(password, hashed):
+        with _verify_lock:
+            _verify_cache.pop(k, None)
+        return False
+    with _verify_lock:
+        _verify_cache[k] = now
+        _verify_cache.move_to_end(k)
+        while len(_verify_cache) > _VERIFY_CACHE_MAX:
+            _verify_cache.popitem(last=False)
+    return True
+
+# Stored digests must be reproducible across restarts and hosts, so the hash is fixed
+# rather than benchmarked at startup; OpenSSL's SHA-256 uses SHA-NI where available.
+_HASH = hashlib.sha256
+
+def reset_token_digest(token: str) -> str:
+    # Only the keyed digest of a reset token is stored, never the token itself
+    return hmac.new(_SIGNING_KEY, token.encode(), _HASH).hexdigest()
+
+# token digest -> in-flight insert started by /auth/forgot; /auth/reset waits on it
+# so a token used immediately after being issued can't race its own write
+_pending_resets: Dict[str, asyncio.Future] = {}
+
+def _on_reset_stored(digest: str):
+    def done(task: asyncio.Future):
+        _pending_resets.pop(digest, None)
+        if not task.cancelled() and task.exception():
+            logging.getLogger("auth").warning(f"Failed to store reset token: {task.exception()}")
+    return done
+
+# Hashing is CPU-bound; run it on the default executor so the event loop keeps serving requests
+async def ahash_password(password: str) -> str:
+    return await asyncio.to_thread(hash_password, password)
+
+async def averify_password(password: str, hashed: str) -> bool:
+    return await asyncio.to_thread(verify_password, password, hashed)
 
 
 def create_access_token(data: Dict, expires_minutes: int = JWT_EXP_MIN) -> str:
     to_encode = data.copy()
-    expire = datetime.utcnow() + timedelta(minutes=expires_minutes)
-    to_encode.update({"exp": expire})
-    return jwt.encode(to_encode, settings.secret_key, algorithm=JWT_ALG)
+    # numeric exp (seconds since epoch) is the canonical claim form
+    to_encode["exp"] = int(time.time()) + expires_minutes * 60
+    return jwt.encode(to_encode, _SIGNING_KEY, algorithm=JWT_ALG)
 
 
 def decode_token(token: str) -> Dict:
     try:
-        return jwt.decode(token, settings.secret_key, algorithms=[JWT_ALG])
+        return jwt.decode(token, _SIGNING_KEY, algorithms=_JWT_ALGS)
     except jwt.PyJWTError:
         raise HTTPException(status_code=401, detail="Invalid or expired token")
 
@@ -57,38 +140,62 @@ async def get_current_user(authorization: Optional[str] = Header(None)) -> Dict:
     if not authorization or not authorization.lower().startswith("bearer "):
         raise HTTPException(status_code=401, detail="Missing bearer token")
     token = authorization.split(" ", 1)[1]
-    payload = decode_token(token)
+    now = time.time()
+    hit = _tok_cache.get(token)
+    if hit and hit[1] <= now:
+        del _tok_cache[token]
+        hit = None
+    if hit:
+        _tok_cache.move_to_end(token)
+        if hit[3] > now:
+            return hit[2]
+        payload, exp = hit[0], hit[1]
+    else:
+        payload = decode_token(token)
+        exp = float(payload.get("exp", 0))
     user_id = payload.get("sub")
     if not user_id:
         raise HTTPException(status_code=401, detail="Invalid token payload")
     user = await users_col.find_one({"user_id": user_id})
     if not user:
+        _tok_cache.pop(token, None)
         raise HTTPException(status_code=401, detail="User not found")
+    _tok_cache[token] = (payload, exp, user, min(exp, now + _TOK_USER_TTL))
+    while len(_tok_cache) > _TOK_CACHE_MAX:
+        _tok_cache.popitem(last=False)
     return user
 
 
+def invalidate_user_tokens(user_id: str) -> None:
+    for token in [t for t, (_, _, u, _) in _tok_cache.items() if u.get("user_id") == user_id]:
+        del _tok_cache[token]
+
+
 @router.post("/signup")
 async def signup(body: SignupIn):
-    existing = await users_col.find_one({"email": body.email.lower()})
-    if existing:
-        raise HTTPException(status_code=400, detail="Email already registered")
     user_id = str(uuid.uuid4())
     doc = {
         "user_id": user_id,
-        "email": body.email.lower(),
+        "email": body.email,
         "name": body.name,
-        "password_hash": hash_password(body.password),
+        "password_hash": await ahash_password(body.password),
         "created_at": datetime.utcnow(),
     }
-    await users_col.insert_one(doc)
+    # the unique email index rejects duplicates, no separate existence check needed
+    try:
+        await users_col.insert_one(doc)
+    except DuplicateKeyError:
+        raise HTTPException(status_code=400, detail="Email already registered")
     token = create_access_token({"sub": user_id, "email": doc["email"]})
     return {"ok": True, "token": token, "user": {"user_id": user_id, "email": doc["email"], "name": doc["name"]}}
 
 @router.post("/login")
 async def login(body: LoginIn):
-    user = await users_col.find_one({"email": body.email.lower()})
-    if not user or not verify_password(body.password, user.get("password_hash", "")):
+    user = await users_col.find_one({"email": body.email}, collation=EMAIL_COLLATION)
+    if not user or not await averify_password(body.password, user.get("password_hash", "")):
         raise HTTPException(status_code=401, detail="Invalid credentials")
+    if pwd_ctx.needs_update(user["password_hash"]):
+        await users_col.update_one({"user_id": user["user_id"]}, {"$set": {"password_hash": await ahash_password(body.password)}})
     token = create_access_token({"sub": user["user_id"], "email": user["email"]})
     return {"ok": True, "token": token, "user": {"user_id": user["user_id"], "email": user["email"], "name": user.get("name")}}
 
@@ -98,19 +205,31 @@ async def me(user=Depends(get_current_user)):
 
 @router.post("/forgot")
 async def forgot(body: ResetRequestIn):
-    user = await users_col.find_one({"email": body.email.lower()})
+    user = await users_col.find_one({"email": body.email}, collation=EMAIL_COLLATION)
     # Do not leak whether user exists
     token = str(uuid.uuid4())
-    doc = {"token": token, "user_id": user["user_id"] if user else None, "created_at": datetime.utcnow(), "expires_at": datetime.utcnow() + timedelta(hours=1)}
-    await resets_col.insert_one(doc)
+    now = datetime.utcnow()
+    digest = reset_token_digest(token)
+    doc = {"token_hash": digest, "user_id": user["user_id"] if user else None, "created_at": now, "expires_at": now + timedelta(hours=1)}
+    # Respond without waiting for the write; failures are logged
+    # motor returns a Future, so ensure_future rather than create_task
+    task = asyncio.ensure_future(resets_col.insert_one(doc))
+    _pending_resets[digest] = task
+    task.add_done_callback(_on_reset_stored(digest))
     # In production you'd send this link via email; here we return token for demo
     return {"ok": True, "token": token}
 
 @router.post("/reset")
 async def reset(body: ResetConfirmIn):
-    rec = await resets_col.find_one({"token": body.token})
-    if not rec or (rec.get("expires_at") and rec["expires_at"] < datetime.utcnow()) or not rec.get("user_id"):
+    digest = reset_token_digest(body.token)
+    pending = _pending_resets.get(digest)
+    if pending:
+        await asyncio.wait([pending])
+    # Claim the token in the same round-trip that looks it up, so it is single-use
+    # and never outlives the password change
+    rec = await resets_col.find_one_and_delete({"token_hash": digest})
+    if not rec or not hmac.compare_digest(rec.get("token_hash", ""), digest) or (rec.get("expires_at") and rec["expires_at"] < datetime.utcnow()) or not rec.get("user_id"):
         raise HTTPException(status_code=400, detail="Invalid or expired token")
-    await users_col.update_one({"user_id": rec["user_id"]}, {"$set": {"password_hash": hash_password(body.new_password)}})
-    await resets_col.delete_one({"token": body.token})
+    await users_col.update_one({"user_id": rec["user_id"]}, {"$set": {"password_hash": await ahash_password(body.new_password)}})
+    invalidate_user_tokens(rec["user_id"])
     return {"ok": True}
\ No newline at end of file
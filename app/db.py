@@ -9,3 +9,6 @@ users_col = db["users"]
 ratings_col = db["ratings"]  # store individual ratings
 prefs_col = db["preferences"]  # optional cached prefs
 resets_col = db["password_resets"]  # password reset tokens
+
+# Case-insensitive matching for user emails; queries must pass it to use the email index
+EMAIL_COLLATION = {"locale": "en", "strength": 2}
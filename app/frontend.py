@@ -1,15 +1,46 @@
 from pathlib import Path
-from flask import Flask, render_template, request, redirect, url_for, flash, session
+from datetime import datetime
+from time import monotonic
+from typing import Dict, Tuple
+from flask import Flask, render_template, request, redirect, url_for, flash, session, g
 import requests
+from requests.adapters import HTTPAdapter
 
 # We read settings at import time to get port and secret
 from .config import settings
+from .auth import decode_token
+from .recommender import REC_MAX_LIMIT
+from .services import (
+    loop_bound,
+    run_sync,
+    submit,
+    wait_result,
+    get_ratings,
+    get_rating_map,
+    get_recommendations,
+    get_genre_recommendations,
+    get_author_recommendations,
+    search_books,
+)
 
 TEMPLATES_DIR = str(Path(__file__).parent / "templates")
 STATIC_DIR = str(Path(__file__).parent / "static")
 
 API_BASE = f"http://127.0.0.1:{settings.port}"
 
+# Reads go through app.services in-process when mounted under the API; this
+# session is used for everything else (writes, and reads when Flask runs as a
+# separate process) so the connection to the API stays open
+_HTTP = requests.Session()
+_HTTP.mount("http://", HTTPAdapter(pool_connections=32, pool_maxsize=64))
+_HTTP.headers.update({"Connection": "keep-alive"})
+
+# user_id -> (fetched_at, {book_id: rating}); short-lived so a page render
+# and the next few navigations share a single ratings query
+RATINGS_CACHE_TTL = 10  # seconds
+RATINGS_CACHE_MAX_USERS = 256
+_ratings_cache: Dict[str, Tuple[float, Dict[str, float]]] = {}
+
 # Featured fallback items to display when API returns no data
 SAMPLE_FEATURED = [
     {
@@ -69,21 +100,112 @@ def api_headers():
     return {}
 
 
+def current_user_id():
+    """Resolve the logged-in user from the session token (validates expiry)"""
+    return decode_token(session["token"]).get("sub")
+
+
+def api_items(coro, path, params=None, auth=False):
+    """Books from a service call: in-process under the API, else over HTTP"""
+    if loop_bound():
+        return run_sync(coro)
+    coro.close()
+    r = _HTTP.get(f"{API_BASE}{path}", params=params, headers=api_headers() if auth else None, timeout=12)
+    r.raise_for_status()
+    return r.json().get("items", [])
+
+
+def load_ratings_page(before=None, before_id=None):
+    """One page of the user's ratings plus query args for the next page (or None)"""
+    if loop_bound():
+        page = run_sync(get_ratings(
+            current_user_id(),
+            before=datetime.fromisoformat(before) if before else None,
+            before_id=before_id,
+        ))
+    else:
+        r = _HTTP.get(f"{API_BASE}/ratings/me", params={"before": before, "before_id": before_id},
+                      headers=api_headers(), timeout=12)
+        r.raise_for_status()
+        page = r.json()
+    nxt = page.get("next")
+    if not nxt:
+        return page.get("ratings", []), None
+    ts = nxt.get("timestamp")
+    return page.get("ratings", []), {"before": ts.isoformat() if isinstance(ts, datetime) else ts, "before_id": nxt["book_id"]}
+
+
+def _fetch_user_ratings():
+    fut = g.pop("_ratings_future", None)
+    if fut is not None:
+        return wait_result(fut)
+    # Lookup dictionary of ratings by book_id
+    if loop_bound():
+        return run_sync(get_rating_map(current_user_id()))
+    lookup = {}
+    params = {"limit": 500}
+    while True:
+        r = _HTTP.get(f"{API_BASE}/ratings/me", params=params, headers=api_headers(), timeout=12)
+        r.raise_for_status()
+        page = r.json()
+        lookup.update({rating["book_id"]: rating["rating"] for rating in page.get("ratings", [])})
+        nxt = page.get("next")
+        if not nxt:
+            return lookup
+        params = {"limit": 500, "before": nxt.get("timestamp"), "before_id": nxt["book_id"]}
+
+
+def _get_user_ratings_cached(user_id):
+    hit = _ratings_cache.get(user_id)
+    if hit and monotonic() - hit[0] < RATINGS_CACHE_TTL:
+        return hit[1]
+    lookup = _fetch_user_ratings()
+    _ratings_cache.pop(user_id, None)
+    if len(_ratings_cache) >= RATINGS_CACHE_MAX_USERS:
+        # drop the oldest entry (dicts keep insertion order)
+        _ratings_cache.pop(next(iter(_ratings_cache)), None)
+    _ratings_cache[user_id] = (monotonic(), lookup)
+    return lookup
+
+
+def prefetch_user_ratings():
+    """Start loading the user's ratings on the API loop while the view fetches books"""
+    if not session.get("token") or not loop_bound() or "_ratings_lookup" in g or "_ratings_future" in g:
+        return
+    user_id = (session.get("user") or {}).get("user_id")
+    hit = _ratings_cache.get(user_id) if user_id else None
+    if hit and monotonic() - hit[0] < RATINGS_CACHE_TTL:
+        return
+    try:
+        g._ratings_future = submit(get_rating_map(current_user_id()))
+    except Exception:
+        # merge_user_ratings_with_books will retry (and handle failure) itself
+        pass
+
+
+def invalidate_user_ratings():
+    """Drop cached ratings for the logged-in user after a rating change"""
+    user_id = (session.get("user") or {}).get("user_id")
+    if user_id:
+        _ratings_cache.pop(user_id, None)
+    g.pop("_ratings_lookup", None)
+
+
 def merge_user_ratings_with_books(books):
     """Merge user ratings with book data for display"""
     if not session.get("token") or not books:
         return books
     
     try:
-        # Fetch user's ratings
-        r = requests.get(f"{API_BASE}/ratings/me", headers=api_headers(), timeout=12)
-        r.raise_for_status()
-        user_ratings = r.json().get("ratings", [])
+        # Fetch user's ratings at most once per request
+        ratings_lookup = g.get("_ratings_lookup")
+        if ratings_lookup is None:
+            user_id = (session.get("user") or {}).get("user_id")
+            ratings_lookup = _get_user_ratings_cached(user_id) if user_id else _fetch_user_ratings()
+            g._ratings_lookup = ratings_lookup
         
-        # Create a lookup dictionary for ratings by book_id
-        ratings_lookup = {rating["book_id"]: rating["rating"] for rating in user_ratings}
-        
-        # Merge ratings with books
+        # Merge ratings with books (copies, so shared/cached book dicts stay untouched)
+        books = [dict(book) for book in books]
         for book in books:
             book_id = book.get("book_id")
             if book_id in ratings_lookup:
@@ -106,13 +228,12 @@ def create_flask_app() -> Flask:
         # Fetch recommended items automatically
         rec_items = []
         rec_error = None
+        prefetch_user_ratings()
         try:
             if session.get("token"):
-                r = requests.get(f"{API_BASE}/recommend/me", params={"limit": 12}, headers=api_headers(), timeout=12)
+                rec_items = api_items(get_recommendations(current_user_id(), limit=12), "/recommend/me", {"limit": 12}, auth=True)
             else:
-                r = requests.get(f"{API_BASE}/recommend/genre", params={"genre": "fiction", "limit": 12}, timeout=12)
-            r.raise_for_status()
-            rec_items = r.json().get("items", [])
+                rec_items = api_items(get_genre_recommendations("fiction", limit=12), "/recommend/genre", {"genre": "fiction", "limit": 12})
         except Exception as e:
             rec_error = str(e)
         # Fallback to featured items if empty
@@ -131,11 +252,9 @@ def create_flask_app() -> Flask:
         items = []
         error = None
         if q:
+            prefetch_user_ratings()
             try:
-                r = requests.get(f"{API_BASE}/search", params={"q": q, "limit": limit}, timeout=12)
-                r.raise_for_status()
-                data = r.json()
-                items = data.get("items", [])
+                items = api_items(search_books(q, limit=limit), "/search", {"q": q, "limit": limit})
             except Exception as e:
                 error = str(e)
         
@@ -151,17 +270,18 @@ def create_flask_app() -> Flask:
         limit = int(request.args.get("limit", 20))
         items = []
         error = None
+        prefetch_user_ratings()
         try:
             if session.get("token") and not (genre or author):
-                r = requests.get(f"{API_BASE}/recommend/me", params={"limit": limit}, headers=api_headers(), timeout=12)
+                # the in-process call skips the API's limit validation, so bound it here
+                rec_limit = max(1, min(limit, REC_MAX_LIMIT))
+                items = api_items(get_recommendations(current_user_id(), limit=rec_limit), "/recommend/me", {"limit": rec_limit}, auth=True)
             elif genre:
-                r = requests.get(f"{API_BASE}/recommend/genre", params={"genre": genre, "limit": limit}, timeout=12)
+                items = api_items(get_genre_recommendations(genre, limit=limit), "/recommend/genre", {"genre": genre, "limit": limit})
             elif author:
-                r = requests.get(f"{API_BASE}/recommend/author", params={"author": author, "limit": limit}, timeout=12)
+                items = api_items(get_author_recommendations(author, limit=limit), "/recommend/author", {"author": author, "limit": limit})
             else:
-                r = requests.get(f"{API_BASE}/recommend/genre", params={"genre": "fiction", "limit": limit}, timeout=12)
-            r.raise_for_status()
-            items = r.json().get("items", [])
+                items = api_items(get_genre_recommendations("fiction", limit=limit), "/recommend/genre", {"genre": "fiction", "limit": limit})
         except Exception as e:
             error = str(e)
         
@@ -191,8 +311,9 @@ def create_flask_app() -> Flask:
                 "publisher": form.get("publisher", ""),
                 "publishedDate": form.get("publishedDate", "")
             }
-            r = requests.post(f"{API_BASE}/ratings", json=payload, headers=api_headers(), timeout=12)
+            r = _HTTP.post(f"{API_BASE}/ratings", json=payload, headers=api_headers(), timeout=12)
             r.raise_for_status()
+            invalidate_user_ratings()
             flash("Rating saved!", "success")
         except Exception as e:
             flash(f"Failed to save rating: {e}", "error")
@@ -206,16 +327,14 @@ def create_flask_app() -> Flask:
             return redirect(url_for("login_page"))
         
         ratings = []
+        next_page = None
         error = None
         try:
-            r = requests.get(f"{API_BASE}/ratings/me", headers=api_headers(), timeout=12)
-            r.raise_for_status()
-            data = r.json()
-            ratings = data.get("ratings", [])
+            ratings, next_page = load_ratings_page(request.args.get("before"), request.args.get("before_id") or None)
         except Exception as e:
             error = f"Failed to load ratings: {e}"
         
-        return render_template("my_ratings.html", title="My Ratings", ratings=ratings, error=error, user=session.get("user"))
+        return render_template("my_ratings.html", title="My Ratings", ratings=ratings, next_page=next_page, error=error, user=session.get("user"))
 
     @app.post("/update-rating")
     def update_rating():
@@ -235,8 +354,9 @@ def create_flask_app() -> Flask:
         try:
             if action == "delete":
                 # Delete the rating (we'll need to add a delete endpoint)
-                r = requests.delete(f"{API_BASE}/ratings/{book_id}", headers=api_headers(), timeout=12)
+                r = _HTTP.delete(f"{API_BASE}/ratings/{book_id}", headers=api_headers(), timeout=12)
                 r.raise_for_status()
+                invalidate_user_ratings()
                 flash("Rating deleted successfully!", "success")
             else:
                 # Update the rating
@@ -257,8 +377,9 @@ def create_flask_app() -> Flask:
                     "publisher": form.get("publisher", ""),
                     "publishedDate": form.get("publishedDate", "")
                 }
-                r = requests.post(f"{API_BASE}/ratings", json=payload, headers=api_headers(), timeout=12)
+                r = _HTTP.post(f"{API_BASE}/ratings", json=payload, headers=api_headers(), timeout=12)
                 r.raise_for_status()
+                invalidate_user_ratings()
                 flash("Rating updated successfully!", "success")
         except Exception as e:
             flash(f"Failed to update rating: {e}", "error")
@@ -275,7 +396,7 @@ def create_flask_app() -> Flask:
         email = request.form.get("email", "").strip()
         password = request.form.get("password", "").strip()
         try:
-            r = requests.post(f"{API_BASE}/auth/login", json={"email": email, "password": password}, timeout=12)
+            r = _HTTP.post(f"{API_BASE}/auth/login", json={"email": email, "password": password}, timeout=12)
             r.raise_for_status()
             data = r.json()
             session["token"] = data.get("token")
@@ -296,7 +417,7 @@ def create_flask_app() -> Flask:
         email = request.form.get("email", "").strip()
         password = request.form.get("password", "").strip()
         try:
-            r = requests.post(f"{API_BASE}/auth/signup", json={"name": name, "email": email, "password": password}, timeout=12)
+            r = _HTTP.post(f"{API_BASE}/auth/signup", json={"name": name, "email": email, "password": password}, timeout=12)
             r.raise_for_status()
             data = r.json()
             session["token"] = data.get("token")
@@ -315,7 +436,7 @@ def create_flask_app() -> Flask:
     def forgot_submit():
         email = request.form.get("email", "").strip()
         try:
-            r = requests.post(f"{API_BASE}/auth/forgot", json={"email": email}, timeout=12)
+            r = _HTTP.post(f"{API_BASE}/auth/forgot", json={"email": email}, timeout=12)
             r.raise_for_status()
             data = r.json()
             flash(f"Reset token generated: {data.get('token')}", "success")
@@ -334,7 +455,7 @@ def create_flask_app() -> Flask:
         token = request.form.get("token", "")
         new_password = request.form.get("new_password", "")
         try:
-            r = requests.post(f"{API_BASE}/auth/reset", json={"token": token, "new_password": new_password}, timeout=12)
+            r = _HTTP.post(f"{API_BASE}/auth/reset", json={"token": token, "new_password": new_password}, timeout=12)
             r.raise_for_status()
             flash("Password reset successful. Please login.", "success")
             return redirect(url_for("login_page"))
@@ -1,24 +1,115 @@
+import asyncio
 import httpx
+from time import monotonic
 from .config import settings
-from typing import List, Dict
+from typing import List, Dict, Optional, Tuple
 
 BASE_URL = "https://www.googleapis.com/books/v1/volumes"
 
-async def search_books_by_keywords(q: str, max_results: int = 20) -> List[Dict]:
+# One pooled client for all searches so TLS connections to Google are reused.
+# Built on first use and rebuilt for a new event loop or after close_client, so
+# a second app lifespan in the same process gets a working client.
+_client: Optional[httpx.AsyncClient] = None
+_client_loop: Optional[asyncio.AbstractEventLoop] = None
+
+# (q, max_results, start_index) -> (expires_at, books); results don't change minute to minute
+SEARCH_CACHE_TTL = 300  # seconds
+TERM_CACHE_TTL = 900  # genre/author lookups recur across users, keep them longer
+SEARCH_CACHE_MAX = 1024
+_search_cache: Dict[Tuple[str, int, int], Tuple[float, List[Dict]]] = {}
+_inflight: Dict[Tuple[str, int, int], asyncio.Future] = {}
+
+# book_id -> (lowercased categories, lowercased authors), each joined with "\x00",
+# filled at ingest so the recommender can substring-match tags with one C-level
+# scan per term and without re-lowercasing a cached book on every request.
+# Kept beside the books rather than on them so API responses stay unchanged.
+BOOK_TAGS_MAX = 20000
+_book_tags: Dict[str, Tuple[str, str]] = {}
+
+# Caps concurrent upstream requests across all users; bursts queue here instead
+# of tripping Google's rate limits. Bound to the loop alongside the client.
+GB_MAX_CONCURRENCY = 8
+_gb_sem: Optional[asyncio.Semaphore] = None
+
+def _upstream() -> Tuple[httpx.AsyncClient, asyncio.Semaphore]:
+    global _client, _client_loop, _gb_sem
+    loop = asyncio.get_running_loop()
+    if _client is None or _client.is_closed or _client_loop is not loop:
+        _client = httpx.AsyncClient(
+            timeout=15,
+            http2=True,
+            limits=httpx.Limits(max_keepalive_connections=20, max_connections=100),
+            base_url=BASE_URL,
+        )
+        _client_loop = loop
+        _gb_sem = asyncio.Semaphore(GB_MAX_CONCURRENCY)
+    return _client, _gb_sem
+
+async def close_client():
+    global _client
+    if _client is not None:
+        await _client.aclose()
+        _client = None
+
+async def search_books_by_keywords(q: str, max_results: int = 20, cache_ttl: float = SEARCH_CACHE_TTL, start_index: int = 0) -> List[Dict]:
+    cache_key = (q, max_results, start_index)
+    hit = _search_cache.get(cache_key)
+    if hit and monotonic() < hit[0]:
+        return list(hit[1])
+    # Concurrent identical searches share one upstream request
+    task = _inflight.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_fetch_books(q, max_results, cache_ttl, start_index))
+        _inflight[cache_key] = task
+        task.add_done_callback(lambda _: _inflight.pop(cache_key, None))
+    # shield: one caller giving up must not cancel the fetch for the others
+    return list(await asyncio.shield(task))
+
+async def _fetch_books(q: str, max_results: int, cache_ttl: float, start_index: int = 0) -> List[Dict]:
     params = {"q": q, "maxResults": max_results}
+    if start_index:
+        params["startIndex"] = start_index
     key = (settings.google_books_api_key or "").strip()
     # Only include key if it looks real (not placeholder or empty)
     if key and not key.startswith("<") and "replace_with" not in key.lower():
         params["key"] = key
+    client, sem = _upstream()
     try:
-        async with httpx.AsyncClient(timeout=15) as client:
-            r = await client.get(BASE_URL, params=params)
-            r.raise_for_status()
-            data = r.json()
+        async with sem:
+            r = await client.get("", params=params)
+        r.raise_for_status()
+        data = r.json()
     except httpx.HTTPError:
         return []
     items = data.get("items", [])
-    return [normalize_book(item) for item in items]
+    books = [normalize_book(item) for item in items]
+    for b in books:
+        if b["book_id"]:
+            _store_tags(b)
+    if len(_search_cache) >= SEARCH_CACHE_MAX:
+        # drop the oldest entry (dicts keep insertion order)
+        _search_cache.pop(next(iter(_search_cache)))
+    _search_cache[(q, max_results, start_index)] = (monotonic() + cache_ttl, books)
+    return books
+
+def _lower_tags(values) -> str:
+    # "\x00" never occurs in a tag, so a term can't match across two tags
+    return "\x00".join((v or "").lower() for v in values or [])
+
+def _store_tags(book: Dict) -> Tuple[str, str]:
+    tags = (_lower_tags(book.get("categories")), _lower_tags(book.get("authors")))
+    _book_tags.pop(book["book_id"], None)
+    if len(_book_tags) >= BOOK_TAGS_MAX:
+        _book_tags.pop(next(iter(_book_tags)))
+    _book_tags[book["book_id"]] = tags
+    return tags
+
+def book_tags(book: Dict) -> Tuple[str, str]:
+    """Lowercased, "\x00"-joined (categories, authors) of a book from a search result"""
+    tags = _book_tags.get(book.get("book_id"))
+    if tags is None:
+        tags = _store_tags(book) if book.get("book_id") else (_lower_tags(book.get("categories")), _lower_tags(book.get("authors")))
+    return tags
 
 def normalize_book(item: Dict) -> Dict:
     v = item.get("volumeInfo", {})
@@ -35,10 +126,11 @@ def normalize_book(item: Dict) -> Dict:
         "infoLink": v.get("infoLink")
     }
 
-async def search_books_by_genre(genre: str, max_results: int = 20):
-    q = f"subject:{genre}"
-    return await search_books_by_keywords(q, max_results)
+# Terms are normalized so "Fiction" and "fiction " share a cache entry
+async def search_books_by_genre(genre: str, max_results: int = 20, start_index: int = 0):
+    q = f"subject:{genre.strip().lower()}"
+    return await search_books_by_keywords(q, max_results, cache_ttl=TERM_CACHE_TTL, start_index=start_index)
 
-async def search_books_by_author(author: str, max_results: int = 20):
-    q = f"inauthor:{author}"
-    return await search_books_by_keywords(q, max_results)
+async def search_books_by_author(author: str, max_results: int = 20, start_index: int = 0):
+    q = f"inauthor:{author.strip().lower()}"
+    return await search_books_by_keywords(q, max_results, cache_ttl=TERM_CACHE_TTL, start_index=start_index)
@@ -1,16 +1,29 @@
-from fastapi import FastAPI, HTTPException, status, Depends
+from fastapi import FastAPI, HTTPException, status, Depends, Query
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import ORJSONResponse
 from .models import RatingIn, PreferenceIn, User
-from .db import users_col, ratings_col, prefs_col
-from .recommender import recommend_for_user, recommend_by_genre, recommend_by_author
-from .google_books import search_books_by_keywords
+from .db import users_col, ratings_col, prefs_col, resets_col, EMAIL_COLLATION
+from .recommender import invalidate_user, REC_MAX_LIMIT
+from .services import (
+    bind_loop,
+    get_ratings,
+    get_recommendations,
+    get_genre_recommendations,
+    get_author_recommendations,
+    search_books,
+)
 from .config import settings
-from typing import List
+from .google_books import close_client
+from typing import List, Optional
+from datetime import datetime, timezone
 from starlette.middleware.wsgi import WSGIMiddleware
 from .frontend import create_flask_app
 from .auth import router as auth_router, get_current_user
+import asyncio
+import os
+from concurrent.futures import ThreadPoolExecutor
 
-app = FastAPI(title="Adhunik Kitaab")
+app = FastAPI(title="Adhunik Kitaab", default_response_class=ORJSONResponse)
 
 app.add_middleware(
     CORSMiddleware,
@@ -26,6 +39,13 @@ app.include_router(auth_router)
 
 @app.on_event("startup")
 async def startup():
+    loop = asyncio.get_running_loop()
+    # password hashing runs via asyncio.to_thread; size the pool for it
+    loop.set_default_executor(
+        ThreadPoolExecutor(max_workers=min(32, (os.cpu_count() or 1) * 4))
+    )
+    # let the Flask views schedule service calls on this loop
+    bind_loop(loop)
     # create indexes for performance
     try:
         from .db import client
@@ -34,10 +54,36 @@ async def startup():
         
         # Create indexes
         await users_col.create_index("user_id", unique=True)
-        await users_col.create_index("email", unique=True)
-        await ratings_col.create_index([("user_id", 1)])
-        await ratings_col.create_index([("book_id", 1)])
+        await users_col.create_index("email", unique=True, collation=EMAIL_COLLATION, name="email_ci")
+        try:
+            await users_col.drop_index("email_1")
+        except Exception:
+            pass
+        # one (user_id, book_id) entry per rating; also serves user_id-only lookups
+        await ratings_col.create_index([("user_id", 1), ("book_id", 1)], unique=True)
+        # /ratings/me pages a user's ratings newest first straight off this index
+        await ratings_col.create_index([("user_id", 1), ("timestamp", -1), ("book_id", -1)])
+        for redundant in ("user_id_1", "book_id_1", "user_id_1_timestamp_-1"):
+            try:
+                await ratings_col.drop_index(redundant)
+            except Exception:
+                pass
         await prefs_col.create_index("user_id", unique=True)
+        # records from before reset tokens were stored as digests can never match; drop them
+        await resets_col.delete_many({"token": {"$exists": True}})
+        # partial so any record without a digest can't collide on a null key
+        await resets_col.create_index(
+            "token_hash",
+            unique=True,
+            partialFilterExpression={"token_hash": {"$exists": True}},
+            name="token_hash_partial",
+        )
+        try:
+            await resets_col.drop_index("token_hash_1")
+        except Exception:
+            pass
+        # Mongo deletes reset records once they expire
+        await resets_col.create_index("expires_at", expireAfterSeconds=0)
         
         import logging
         logging.getLogger("startup").info("Database indexes created successfully")
@@ -45,10 +91,13 @@ async def startup():
         import logging
         logging.getLogger("startup").warning(f"Skipping DB index creation: {e}")
 
+@app.on_event("shutdown")
+async def shutdown():
+    await close_client()
+
 @app.post("/users", status_code=201)
 async def create_user(user: User):
     doc = user.dict()
-    from datetime import datetime
     doc["created_at"] = datetime.utcnow()
     try:
         await users_col.insert_one(doc)
@@ -61,35 +110,25 @@ async def add_rating(r: RatingIn, user=Depends(get_current_user)):
     # Override user_id from token
     doc = r.dict()
     doc["user_id"] = user["user_id"]
-    doc["timestamp"] = doc.get("timestamp") or __import__("datetime").datetime.utcnow()
+    if not doc.get("timestamp"):
+        doc["timestamp"] = datetime.now(timezone.utc)
     await ratings_col.update_one(
         {"user_id": doc["user_id"], "book_id": doc["book_id"]},
         {"$set": doc},
         upsert=True,
     )
+    invalidate_user(doc["user_id"])
     return {"ok": True}
 
 @app.get("/ratings/me")
-async def get_my_ratings(user=Depends(get_current_user)):
-    """Get all ratings for the current user with book details"""
-    cursor = ratings_col.find({"user_id": user["user_id"]}).sort("timestamp", -1)
-    ratings = []
-    async for rating in cursor:
-        # Include all rating data including book metadata if available
-        rating_data = {
-            "book_id": rating.get("book_id"),
-            "rating": rating.get("rating"),
-            "timestamp": rating.get("timestamp"),
-            "title": rating.get("title"),
-            "authors": rating.get("authors", []),
-            "categories": rating.get("categories", []),
-            "thumbnail": rating.get("thumbnail"),
-            "infoLink": rating.get("infoLink"),
-            "publisher": rating.get("publisher"),
-            "publishedDate": rating.get("publishedDate")
-        }
-        ratings.append(rating_data)
-    return {"count": len(ratings), "ratings": ratings}
+async def get_my_ratings(limit: int = 50, before: Optional[datetime] = None, before_id: Optional[str] = None,
+                         user=Depends(get_current_user)):
+    """Get the current user's ratings with book details, newest first.
+
+    Returns up to ``limit`` ratings; pass ``next.timestamp`` and ``next.book_id`` back
+    as ``before`` and ``before_id`` for the following page.
+    """
+    return await get_ratings(user["user_id"], limit=max(1, min(limit, 500)), before=before, before_id=before_id)
 
 @app.delete("/ratings/{book_id}")
 async def delete_rating(book_id: str, user=Depends(get_current_user)):
@@ -97,36 +136,38 @@ async def delete_rating(book_id: str, user=Depends(get_current_user)):
     result = await ratings_col.delete_one({"user_id": user["user_id"], "book_id": book_id})
     if result.deleted_count == 0:
         raise HTTPException(status_code=404, detail="Rating not found")
+    invalidate_user(user["user_id"])
     return {"ok": True, "message": "Rating deleted successfully"}
 
 @app.get("/recommend/me")
-async def recommend_me(limit: int = 20, user=Depends(get_current_user)):
-    items = await recommend_for_user(user["user_id"], limit=limit)
+async def recommend_me(limit: int = Query(20, ge=1, le=REC_MAX_LIMIT), user=Depends(get_current_user)):
+    items = await get_recommendations(user["user_id"], limit=limit)
     return {"count": len(items), "items": items}
 
 @app.post("/preferences", status_code=201)
 async def set_preferences(p: PreferenceIn):
     await prefs_col.update_one({"user_id": p.user_id}, {"$set": p.dict()}, upsert=True)
+    invalidate_user(p.user_id)
     return {"ok": True}
 
 @app.get("/search")
 async def search(q: str, limit: int = 10):
-    items = await search_books_by_keywords(q, max_results=limit)
+    items = await search_books(q, limit=limit)
     return {"count": len(items), "items": items}
 
 @app.get("/recommend/user/{user_id}")
-async def recommend_user(user_id: str, limit: int = 20):
-    items = await recommend_for_user(user_id, limit=limit)
+async def recommend_user(user_id: str, limit: int = Query(20, ge=1, le=REC_MAX_LIMIT)):
+    items = await get_recommendations(user_id, limit=limit)
     return {"count": len(items), "items": items}
 
 @app.get("/recommend/genre")
 async def recommend_genre(genre: str, limit: int = 20):
-    items = await recommend_by_genre(genre, limit=limit)
+    items = await get_genre_recommendations(genre, limit=limit)
     return {"count": len(items), "items": items}
 
 @app.get("/recommend/author")
 async def recommend_author(author: str, limit: int = 20):
-    items = await recommend_by_author(author, limit=limit)
+    items = await get_author_recommendations(author, limit=limit)
     return {"count": len(items), "items": items}
 
 @app.get("/health")
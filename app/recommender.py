@@ -1,75 +1,171 @@
 from .db import ratings_col, prefs_col, users_col
-from .google_books import search_books_by_author, search_books_by_genre
-from typing import List, Dict
+from .google_books import search_books_by_author, search_books_by_genre, book_tags
+from typing import AsyncIterator, List, Dict, Optional, Set, Tuple
 import asyncio
-from collections import Counter, defaultdict
-import math
+import heapq
+import time
+
+# user_id -> (computed_at, books ranked for the largest limit asked so far); smaller
+# limits are served by slicing. Dropped whenever the user's ratings or prefs change.
+REC_CACHE_TTL = 300  # seconds
+REC_CACHE_MAX_USERS = 1024
+REC_MAX_LIMIT = 100  # enforced by the routes; keeps one cached list per user small
+_rec_cache: Dict[str, Tuple[float, int, List[Dict]]] = {}
+# user_id -> marker of the computation in flight; invalidate_user removes it so a
+# result that raced a write isn't cached. Entries only live while computing.
+_rec_pending: Dict[str, object] = {}
+
+def invalidate_user(user_id: str) -> None:
+    _rec_cache.pop(user_id, None)
+    _rec_pending.pop(user_id, None)
+
+def _top_tags_stage(field: str, top_n: int) -> List[Dict]:
+    # rating-weighted tag totals, highest first, computed by Mongo
+    return [
+        {"$unwind": f"${field}"},
+        {"$group": {"_id": {"$toLower": f"${field}"}, "s": {"$sum": "$rating"}}},
+        # keep $limit directly after $sort: Mongo then runs a top-k sort holding only top_n tags
+        {"$sort": {"s": -1, "_id": 1}},
+        {"$limit": top_n},
+    ]
 
 async def get_user_top_genres_and_authors(user_id: str, top_n: int = 5):
-    # Fetch ratings by user
-    cursor = ratings_col.find({"user_id": user_id})
-    genre_counts = Counter()
-    author_counts = Counter()
-    async for r in cursor:
-        # r expected to contain book metadata snapshot (if saved) else just book_id -> then we would fetch details
-        if "categories" in r and r["categories"]:
-            for g in r["categories"]:
-                genre_counts[g.lower()] += r.get("rating", 0)
-        if "authors" in r and r["authors"]:
-            for a in r["authors"]:
-                author_counts[a.lower()] += r.get("rating", 0)
-    top_genres = [g for g, _ in genre_counts.most_common(top_n)]
-    top_authors = [a for a, _ in author_counts.most_common(top_n)]
+    """The user's top genres and authors, weighted by rating, in one aggregation"""
+    pipeline = [
+        {"$match": {"user_id": user_id}},
+        {"$facet": {
+            "genres": _top_tags_stage("categories", top_n),
+            "authors": _top_tags_stage("authors", top_n),
+        }},
+    ]
+    result = await ratings_col.aggregate(pipeline).to_list(length=1)
+    facets = result[0] if result else {}
+    top_genres = [g["_id"] for g in facets.get("genres", []) if g["_id"]]
+    top_authors = [a["_id"] for a in facets.get("authors", []) if a["_id"]]
     return top_genres, top_authors
 
-async def recommend_for_user(user_id: str, limit: int = 20) -> List[Dict]:
-    # 1) derive user's top genres & authors
-    top_genres, top_authors = await get_user_top_genres_and_authors(user_id, top_n=3)
+def _pref_terms(values, top_n: int = 3) -> List[str]:
+    return [v.strip().lower() for v in values or [] if v and v.strip()][:top_n]
 
-    # 2) get books for each genre/author (concurrently)
-    tasks = []
+async def get_rated_ids(user_id: str) -> Set[str]:
+    return set(await ratings_col.distinct("book_id", {"user_id": user_id}))
+
+def _score(b: Dict, top_genres: List[str], top_authors: List[str], rated_ids) -> float:
+    # Plain Python on purpose: a recommendation sees at most a few dozen candidates
+    # (six searches of 10, or twice that when second pages are needed), where building arrays for NumPy
+    # or a JIT-compiled kernel costs more than it saves.
+    score = 1.0
+    cats_lc, auths_lc = book_tags(b)
+    # genre match boost: a top genre counts if it occurs in any category
     for g in top_genres:
-        tasks.append(search_books_by_genre(g, max_results=10))
+        if g in cats_lc:
+            score += 2.0
+    # author match boost
     for a in top_authors:
-        tasks.append(search_books_by_author(a, max_results=10))
-    # if user has no prefs, fallback to generic popular subjects
-    if not tasks:
-        tasks.append(search_books_by_genre("fiction", max_results=15))
-        tasks.append(search_books_by_genre("nonfiction", max_results=15))
-
-    results = await asyncio.gather(*tasks)
-    flat = [b for sub in results for b in sub]
-
-    # 3) score books: base score + boost if matches user's top genres/authors + penalize already rated books
-    scored = {}
-    rated_books_cursor = ratings_col.find({"user_id": user_id})
-    rated_ids = set()
-    async for r in rated_books_cursor:
-        rated_ids.add(r["book_id"])
-
-    for b in flat:
-        bid = b["book_id"]
-        if not bid:
-            continue
-        score = 1.0
-        # genre match boost
-        for g in top_genres:
-            if any(g in (c or "").lower() for c in b.get("categories", [])):
-                score += 2.0
-        # author match boost
-        for a in top_authors:
-            if any(a in (auth or "").lower() for auth in b.get("authors", [])):
-                score += 2.5
-        # small boost for not already rated
-        if bid not in rated_ids:
-            score += 0.5
-        # de-dup best version
-        if bid not in scored or score > scored[bid]["score"]:
-            scored[bid] = {"score": score, "book": b}
-
-    # return top N sorted
-    sorted_books = sorted(scored.values(), key=lambda x: x["score"], reverse=True)
-    return [s["book"] for s in sorted_books[:limit]]
+        if a in auths_lc:
+            score += 2.5
+    # small boost for not already rated
+    if b["book_id"] not in rated_ids:
+        score += 0.5
+    return score
+
+async def recommend_for_user(user_id: str, limit: int = 20) -> List[Dict]:
+    hit = _rec_cache.get(user_id)
+    if hit and hit[1] >= limit and time.monotonic() - hit[0] < REC_CACHE_TTL:
+        return hit[2][:limit]
+    marker = _rec_pending[user_id] = object()
+    try:
+        books = await _compute_recommendations(user_id, limit)
+    finally:
+        current = _rec_pending.get(user_id) is marker
+        if current:
+            del _rec_pending[user_id]
+    if current:
+        _rec_cache.pop(user_id, None)
+        if len(_rec_cache) >= REC_CACHE_MAX_USERS:
+            _rec_cache.pop(next(iter(_rec_cache)))
+        _rec_cache[user_id] = (time.monotonic(), limit, books)
+    return list(books)
+
+async def _compute_recommendations(user_id: str, limit: int) -> List[Dict]:
+    scores: List[float] = []
+    books: List[Dict] = []
+    async for score, book in iter_recommendation_candidates(user_id, want=limit):
+        scores.append(score)
+        books.append(book)
+    # return top N by score (ties keep arrival order)
+    idx = heapq.nlargest(limit, range(len(scores)), key=scores.__getitem__)
+    return [books[i] for i in idx]
+
+async def iter_recommendation_candidates(user_id: str, want: Optional[int] = None) -> AsyncIterator[Tuple[float, Dict]]:
+    """Yield (score, book) for each distinct candidate as soon as its search returns.
+
+    Order is arrival order, not rank; recommend_for_user collects and ranks them.
+    Second result pages are fetched only if first pages gave fewer than ``want`` unrated books.
+    """
+    # rated ids are only needed for scoring, so that query runs while we
+    # derive the top genres & authors and while the searches are in flight
+    rated_task = asyncio.create_task(get_rated_ids(user_id))
+
+    # saved preferences seed cold-start users; fetched alongside the ratings aggregation
+    prefs_task = asyncio.ensure_future(prefs_col.find_one({"user_id": user_id}, {"favorite_genres": 1, "favorite_authors": 1}))
+    tasks: List[asyncio.Future] = []
+    next_pages: List[asyncio.Future] = []
+    try:
+        # 1) derive user's top genres & authors
+        top_genres, top_authors = await get_user_top_genres_and_authors(user_id, top_n=3)
+        if top_genres or top_authors:
+            prefs_task.cancel()
+        else:
+            prefs = await prefs_task or {}
+            top_genres = _pref_terms(prefs.get("favorite_genres"))
+            top_authors = _pref_terms(prefs.get("favorite_authors"))
+
+        # 2) get books for each genre/author (concurrently)
+        searches = [(search_books_by_genre, g, 10) for g in top_genres]
+        searches += [(search_books_by_author, a, 10) for a in top_authors]
+        # if user has no prefs, fallback to generic popular subjects
+        if not searches:
+            searches = [(search_books_by_genre, "fiction", 15), (search_books_by_genre, "nonfiction", 15)]
+        tasks = [asyncio.ensure_future(fn(term, max_results=n)) for fn, term, n in searches]
+
+        # 3) score books as each search returns, so the slowest fetch doesn't hold up the rest:
+        # base score + boost if matches user's top genres/authors + penalize already rated books
+        seen = set()
+        rated_ids = await rated_task
+
+        def fresh(books):
+            for b in books:
+                bid = b.get("book_id")
+                # the same book often comes back from several searches; score it once
+                if bid and bid not in seen:
+                    seen.add(bid)
+                    yield _score(b, top_genres, top_authors, rated_ids), b
+
+        unrated = 0
+        for fut in asyncio.as_completed(tasks):
+            for score, b in fresh(await fut):
+                unrated += b["book_id"] not in rated_ids
+                yield score, b
+        if want is None or unrated >= want:
+            return
+        # too few unrated candidates: fetch the second page of each term whose first
+        # page came back full (a short page means the term has nothing more)
+        next_pages = [
+            asyncio.ensure_future(fn(term, max_results=n, start_index=n))
+            for (fn, term, n), t in zip(searches, tasks)
+            if len(t.result()) >= n
+        ]
+        for fut in asyncio.as_completed(next_pages):
+            for c in fresh(await fut):
+                yield c
+    finally:
+        # on an error or an early stop by the consumer, don't leave lookups running
+        for t in (rated_task, prefs_task, *tasks, *next_pages):
+            if not t.done():
+                t.cancel()
+            elif not t.cancelled():
+                t.exception()  # mark a failure as retrieved so it isn't logged as unhandled
 
 # Simple public API: recommend by genre or author without personalization
 async def recommend_by_genre(genre: str, limit: int = 20):
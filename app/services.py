@@ -0,0 +1,108 @@
+import asyncio
+import concurrent.futures
+from datetime import datetime
+from typing import Dict, List, Optional
+from .db import ratings_col
+from .recommender import recommend_for_user, recommend_by_genre, recommend_by_author
+from .google_books import search_books_by_keywords
+
+# Data access shared by the FastAPI routes and the Flask views. When Flask is
+# mounted in the API process it runs in WSGI worker threads and schedules these
+# coroutines on the API's event loop via run_sync instead of making HTTP calls
+# back into the same process. A standalone Flask process has no bound loop
+# (see loop_bound) and the views fall back to calling the API over HTTP.
+
+_loop: Optional[asyncio.AbstractEventLoop] = None
+
+def bind_loop(loop: asyncio.AbstractEventLoop) -> None:
+    global _loop
+    _loop = loop
+
+def loop_bound() -> bool:
+    """True when running inside the API process with its event loop up"""
+    return _loop is not None and _loop.is_running()
+
+def submit(coro) -> "concurrent.futures.Future":
+    """Schedule a coroutine on the API event loop from a non-async thread"""
+    if not loop_bound():
+        coro.close()
+        raise RuntimeError("API event loop is not running")
+    return asyncio.run_coroutine_threadsafe(coro, _loop)
+
+def wait_result(fut: "concurrent.futures.Future", timeout: float = 12):
+    """Wait for a submitted coroutine; on timeout, cancel it on the API loop"""
+    try:
+        return fut.result(timeout)
+    except concurrent.futures.TimeoutError:
+        # nobody will read the result, so don't let it keep running
+        fut.cancel()
+        raise
+
+def run_sync(coro, timeout: float = 12):
+    """Run a coroutine on the API event loop and wait for its result"""
+    return wait_result(submit(coro), timeout)
+
+
+# Fields returned for each rating; Mongo drops the rest before they hit the wire
+RATING_PROJECTION = {
+    "_id": 0,
+    "book_id": 1,
+    "rating": 1,
+    "timestamp": 1,
+    "title": 1,
+    "authors": 1,
+    "categories": 1,
+    "thumbnail": 1,
+    "infoLink": 1,
+    "publisher": 1,
+    "publishedDate": 1,
+}
+
+RATINGS_PAGE_SIZE = 50
+
+async def get_ratings(user_id: str, limit: int = RATINGS_PAGE_SIZE, before: Optional[datetime] = None,
+                      before_id: Optional[str] = None) -> Dict:
+    """Get a page of a user's ratings with book details, newest first.
+
+    Pages are keyed on (timestamp, book_id) so ratings sharing a timestamp aren't
+    skipped: pass the previous page's ``next`` values as ``before``/``before_id``.
+    ``before_id`` without ``before`` continues among ratings with no timestamp,
+    which sort last.
+    """
+    query = {"user_id": user_id}
+    if before is not None:
+        after_boundary = [{"timestamp": {"$lt": before}}, {"timestamp": None}]
+        if before_id is not None:
+            after_boundary.append({"timestamp": before, "book_id": {"$lt": before_id}})
+        query["$or"] = after_boundary
+    elif before_id is not None:
+        query["timestamp"] = None
+        query["book_id"] = {"$lt": before_id}
+    cursor = (
+        ratings_col.find(query, projection=RATING_PROJECTION)
+        .sort([("timestamp", -1), ("book_id", -1)])
+        .limit(limit)
+    )
+    ratings = await cursor.to_list(length=limit)
+    next_page = None
+    if len(ratings) == limit:
+        last = ratings[-1]
+        next_page = {"timestamp": last.get("timestamp"), "book_id": last["book_id"]}
+    return {"count": len(ratings), "ratings": ratings, "next": next_page}
+
+async def get_rating_map(user_id: str) -> Dict[str, float]:
+    """All of a user's ratings as {book_id: rating}, for annotating book lists"""
+    cursor = ratings_col.find({"user_id": user_id}, projection={"_id": 0, "book_id": 1, "rating": 1})
+    return {r["book_id"]: r["rating"] async for r in cursor}
+
+async def get_recommendations(user_id: str, limit: int = 20) -> List[Dict]:
+    return await recommend_for_user(user_id, limit=limit)
+
+async def get_genre_recommendations(genre: str, limit: int = 20) -> List[Dict]:
+    return await recommend_by_genre(genre, limit=limit)
+
+async def get_author_recommendations(author: str, limit: int = 20) -> List[Dict]:
+    return await recommend_by_author(author, limit=limit)
+
+async def search_books(q: str, limit: int = 10) -> List[Dict]:
+    return await search_books_by_keywords(q, max_results=limit)